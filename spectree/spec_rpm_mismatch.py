@@ -15,12 +15,14 @@ TODO:
 
 import argparse
 import concurrent.futures
-import enum
-import html.parser
+import contextlib
 import logging
 import os
 import re
 import shlex
+import sqlite3
+import string
+import subprocess
 import sys
 import textwrap
 import time
@@ -28,7 +30,7 @@ import urllib.parse
 from dataclasses import dataclass
 from html import escape, unescape
 from logging import debug, error, fatal, info, warning
-from typing import Dict, List, Optional, Set, Tuple, Type, TypeVar
+from typing import Dict, FrozenSet, List, Optional, Set, Tuple, Type, TypeVar
 
 from spectree import spectree
 
@@ -36,6 +38,14 @@ from spectree import spectree
 # Parallelize spec parsing with a bit more than the number of available cores
 PARALLEL_THREADS = int(1.5 * len(os.sched_getaffinity(0)))
 
+# Number of spec files to parse with each invocation of rpmspec, to spread its
+# start-up cost over many files
+SPEC_BATCH_SIZE = 32
+
+# Cache of SRPM names generated by spec files in previous runs
+STUB_CACHE_PATH = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+                               'spec-tree', 'stubs.db')
+
 # SRPM_SOURCE_TEMPLATE = 'ftp://distrib-coffee.ipsl.jussieu.fr/pub/linux/Mageia/distrib/{version}/SRPMS/{media}/{section}/'
 SRPM_SOURCE_TEMPLATE = 'https://distrib-coffee.ipsl.jussieu.fr/pub/linux/Mageia/distrib/{version}/SRPMS/{media}/{section}/'
 SRPM_DISTRO_RELEASE = '10'  # Default distro release number, i.e. the 10 in mga10
@@ -46,6 +56,8 @@ SRPM_MEDIAS = ['tainted', 'nonfree', 'core']
 SRPM_SECTION = 'release'
 
 SVNWEB_URL_TEMPLATE = 'https://svnweb.mageia.org/packages/{version}/{package}/current/SPECS/{package}.spec'
+# SVNWEB_URL_TEMPLATE with the version filled in, since it's the same for every package
+SVNWEB_PACKAGE_URL_TEMPLATE = SVNWEB_URL_TEMPLATE.format(version=SRPM_VERSION, package='{package}')
 
 HTML_HEADER = textwrap.dedent('''\
      <!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.1//EN" "http://www.w3.org/TR/xhtml11/DTD/xhtml11.dtd">
@@ -71,27 +83,155 @@ HTML_FOOTER = textwrap.dedent('''
     </html>
 ''')
 
+HTML_NO_RPM_HEADER = textwrap.dedent('''
+    <a id="no_rpm"></a>
+    <h2>Spec files with no matching RPM of any version</h2>
+
+    There is no package SRPM in the {version} release matching the associated
+    .spec file. This may be because the package was imported but never
+    successfully built, or because the package has been obsoleted and
+    removed from the distribution but the .spec file was never moved to
+    packages/obsolete.
+    <p>({count} packages)</p>
+    <!-- Extract the data in this table in CSV format with the command:
+         xmlstarlet sel -N x=http://www.w3.org/1999/xhtml -t -m '//x:table[@id="norpms"]/x:tr[x:td]' -v 'x:td[2]' -o ',' -v 'x:td[1]' -nl
+    -->
+    <table id="norpms">
+    <tr>
+      <th>Maintainer</th>
+      <th>Package</th>
+    </tr>
+''')
+
+HTML_NO_RPM_ROW = textwrap.dedent('''
+    <tr>
+      <td>{maintainer}</td>
+      <td><a href="{url}">{package}</a></td>
+    </tr>
+''')
+
+HTML_WRONG_VERSION_HEADER = textwrap.dedent('''
+    <a id="wrong_version"></a>
+    <h2>Wrong RPM version</h2>
+
+    The latest version of the SRPM does not match the version in the .spec
+    file.  This may be because no-one has submitted the latest version to
+    be built, or because the last attempted build failed. This section will
+    be very large between the time a distro release is branched and the
+    first mass build of the next release version.
+    A package may also show up here as a false positive if it was
+    changed or built around the same time this report was generated.
+    <span class="release">Blue shaded lines</span> are packages with
+    equal versions but differ only in the release number.
+    <span class="distrib">Red shaded lines</span> are packages that
+    haven't been rebuilt since the last distribution release.
+    <p>({count} packages)</p>
+    <!-- Extract the data in this table in CSV format with the command:
+         xmlstarlet sel -N x=http://www.w3.org/1999/xhtml -t -m '//x:table[@id="wrongversions"]/x:tr[x:td]' -v 'x:td[2]' -o ',' -v 'x:td[3]' -o ',' -v 'x:td[1]' -nl
+    -->
+    <table id="wrongversions">
+    <tr>
+      <th>Maintainer</th>
+      <th>RPM version</th>
+      <th>Spec version</th>
+    </tr>
+''')
+
+HTML_WRONG_VERSION_ROW = textwrap.dedent('''
+    <tr{match_class}>
+      <td>{maintainer}</td>
+      <td>{base_name}</td>
+      <td><a href="{url}">{srpm_name}</a></td>
+    </tr>
+''')
+
+HTML_PARSE_ERROR_HEADER = textwrap.dedent('''
+    <a id="errors"></a>
+    <h2>Could not determine version number from these packages</h2>
+
+    This could be due to a syntax error in the .spec file, a missing
+    %include file (such files are not normally available to this reporting
+    script so this is expected), a missing utility used in command
+    substitution (BuildRequires: are not normally available to this
+    reporting script so this is expected), a mismatch between the SVN
+    directory and the .spec file name, or an internal error in the script
+    generating this report.
+    <p>({count} packages)</p>
+    <!-- Extract the data in this table in CSV format with the command:
+         xmlstarlet sel -N x=http://www.w3.org/1999/xhtml -t -m '//x:table[@id="noversions"]/x:tr[x:td]' -v 'x:td[1]' -nl
+    -->
+    <table id="noversions">
+    <tr>
+      <th>Package</th>
+    </tr>
+''')
+
+HTML_PARSE_ERROR_ROW = textwrap.dedent('''
+    <tr>
+      <td><a href="{url}">{package}</a></td>
+    </tr>
+''')
+
+HTML_MATCH_VERSION_HEADER = textwrap.dedent('''
+    <p>({count} packages)</p>
+    <!-- Extract the data in this table in CSV format with the command:
+         xmlstarlet sel -N x=http://www.w3.org/1999/xhtml -t -m '//x:table[@id="matchingversions"]/x:tr[x:td]' -v 'x:td[2]' -o ',' -v 'x:td[1]' -nl
+    -->
+    <table id="matchingversions">
+    <tr>
+      <th>Maintainer</th>
+      <th>Spec/RPM version</th>
+    </tr>
+''')
 
-PACKAGE_RE = re.compile(r'^(.*)(-[\w\.+~^]+-[\w\.]+\.mga(\d+))(\.\w+)?\.src\.rpm$')
+HTML_MATCH_VERSION_ROW = textwrap.dedent('''
+    <tr>
+      <td>{maintainer}</td>
+      <td>{srpm_name}</td>
+    </tr>
+''')
 
 
-def package_name(rpm: str) -> str:
-    'Determine package name from RPM file name'
-    match = PACKAGE_RE.match(rpm)
-    if match:
-        return match.group(1)
-    return ''
+# Characters allowed in each component of an RPM file name
+WORD_CHARS = frozenset(string.ascii_letters + string.digits + '_')
+VERSION_CHARS = WORD_CHARS | frozenset('.+~^')
+RELEASE_CHARS = WORD_CHARS | frozenset('.')
 
 
-def rpm_base_name(rpm: str) -> str:
-    'Determine name + version + release from RPM file name'
-    match = PACKAGE_RE.match(rpm)
-    if match:
-        return match.group(1) + match.group(2)
-    return ''
+def parse_rpm_name(rpm_name: str) -> Tuple[str, str, str, str, str]:
+    '''Split an RPM name like foo-1.23-4.mga9.nonfree into its components
 
+    The distro section (e.g. .nonfree) is optional and any .src.rpm extension
+    must already have been removed. This is done with string operations rather
+    than a regex since it is run on every package in the distribution.
 
-PACKAGE_BASE_RE = re.compile(r'^(.*)(-[\w\.+]+)-([\w\.]+)\.mga(\d+)')
+    Return: (name, version, release, distrib, section)
+    '''
+    end = len(rpm_name)
+    while (mga := rpm_name.rfind('.mga', 0, end)) >= 0:
+        end = mga
+        distrib, dot, section = rpm_name[mga + 4:].partition('.')
+        if not distrib.isdecimal() or (dot and not (section and WORD_CHARS.issuperset(section))):
+            continue
+        name_ver, dash, release = rpm_name[:mga].rpartition('-')
+        name, dash2, version = name_ver.rpartition('-')
+        if (dash and dash2 and version and release and VERSION_CHARS.issuperset(version)
+                and RELEASE_CHARS.issuperset(release)):
+            return (name, version, release, distrib, section)
+    return ('', '', '', '', '')
+
+
+def parse_rpm(rpm: str) -> Tuple[str, str]:
+    '''Determine package name and name + version + release from RPM file name
+
+    Return: (name, base name)
+    '''
+    if not rpm.endswith('.src.rpm'):
+        return ('', '')
+    name, version, release, distrib, _ = parse_rpm_name(rpm[:-len('.src.rpm')])
+    if not version:
+        return ('', '')
+    return (name, f'{name}-{version}-{release}.mga{distrib}')
 
 
 def rpm_versions(rpm_base: str) -> Tuple[str, str, str, str]:
@@ -99,110 +239,86 @@ def rpm_versions(rpm_base: str) -> Tuple[str, str, str, str]:
 
     Return: (name, version, release, distrib)
     '''
-    match = PACKAGE_BASE_RE.match(rpm_base)
-    if match:
-        return (match.group(1), match.group(2), match.group(3), match.group(4))
-    return ('', '', '', '')
+    return parse_rpm_name(rpm_base)[:4]
 
 
-def retrieve_dir_contents(url: str) -> List[str]:
-    'Return a directory listing of the remote URL'
+def retrieve_dir_contents(url: str, suffix: str = '') -> List[str]:
+    '''Return a directory listing of the remote URL of file names ending in suffix'''
     u = urllib.parse.urlparse(url)
     if u.scheme in ('ftp', 'ftps'):
-        return retrieve_dir_contents_curl(url)
+        return retrieve_dir_contents_curl(url, suffix)
 
     if u.scheme in ('http', 'https'):
-        return retrieve_dir_contents_http(url)
+        return retrieve_dir_contents_http(url, suffix)
 
     if u.scheme == 'file' and u.netloc in ('localhost', ''):
-        return os.listdir(u.path)
+        with os.scandir(u.path) as entries:
+            return [entry.name for entry in entries if entry.name.endswith(suffix)]
 
     raise RuntimeError('SRPM URL type %s not supported' % url)
 
 
-def retrieve_dir_contents_curl(url: str) -> List[str]:
-    '''Return a directory listing of the remote ftp URL
+def retrieve_dir_contents_curl(url: str, suffix: str = '') -> List[str]:
+    '''Return a directory listing of the remote ftp URL of file names ending in suffix
 
     ftp allows a trivially-parsed directory listing.
     '''
     listing = []
-    cmd = 'curl -f -s -l --ftp-method SINGLECWD --ssl -- ' + shlex.quote(url)
-    info("Running: %s", cmd)
-    with os.popen(cmd, 'r') as pipe:
-        while line := pipe.readline():
-            if line := line.strip():
+    cmd = ['curl', '-f', '-s', '-l', '--ftp-method', 'SINGLECWD', '--ssl', '--', url]
+    info("Running: %s", shlex.join(cmd))
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True) as proc:
+        for line in proc.stdout:
+            if (line := line.strip()) and line.endswith(suffix):
                 listing.append(line)
-        if pipe.close():
-            error(f'Error retrieving files at %{url}')
+    if proc.returncode:
+        error(f'Error retrieving files at %{url}')
     return listing
 
 
-class HTMLDirParser(html.parser.HTMLParser):
-    '''Parse the HTML resulting from an HTTP directory request.
+# Matches the target of each link in an HTML directory listing, except for
+# Apache & IIS' special column sorting links which start with ?
+HREF_RE = re.compile(r'''<a\s[^>]*?\bhref\s*=\s*["']([^"'?][^"']*)["']''', re.IGNORECASE)
+
+
+def decode_href(href: str) -> str:
+    '''Decode the value of an href attribute into the URL path it refers to.
+
+    Most links in a directory listing contain neither HTML entities nor URL
+    escapes, so only decode what is actually present.
+    '''
+    if '&' in href:
+        href = unescape(href)
+    if '%' in href:
+        href = urllib.parse.unquote(href)
+    return href
+
+
+def retrieve_dir_contents_http(url: str, suffix: str = '') -> List[str]:
+    '''Return an HTML directory listing via HTTP/S of file names ending in suffix
 
-    This works with the output from Apache, IIS, lighttpd and nginx. The first
-    link in the links attribute is the parent directory.
+    This works with the output from Apache, IIS, lighttpd and nginx, which all
+    use a simple enough format that scanning the links with a regex suffices.
     Some servers support returning directories in structured formats (e.g., XML
     or JSON) but it seems to be controlled server-side and the client doesn't
     appear to be able to influence it.
     '''
-
-    class TableState(enum.IntEnum):
-        '''States for the HTML parser.'''
-        NONE = enum.auto()
-        TR = enum.auto()
-        TH = enum.auto()
-
-    def __init__(self):
-        super().__init__()
-        self.table_state = self.TableState.NONE
-        self.links = []
-
-    def error(self, message: str):
-        warning("%s", message)
-
-    def handle_starttag(self, tag, attrs):
-        if tag == 'th':
-            self.table_state = self.TableState.TH
-
-        elif tag == 'tr':
-            self.table_state = self.TableState.TR
-
-        elif tag == 'a':
-            if self.table_state == self.TableState.TH:
-                # Ignore links in the table header
-                return
-            attrdict = dict(attrs)
-            href = urllib.parse.unquote(unescape(attrdict['href']))
-            # Remove Apache & IIS' special column sorting links
-            if not href.startswith('?'):
-                self.links.append(href)
-        # ignore all other tags
-
-
-def retrieve_dir_contents_http(url: str) -> List[str]:
-    'Return an HTML directory listing via HTTP/S'
-    htmlp = HTMLDirParser()
-
-    cmd = 'curl -f -s --compressed -- ' + shlex.quote(url)
-    info("Running: %s", cmd)
-    with os.popen(cmd, 'r') as pipe:
-        while data := pipe.read(1024):
-            htmlp.feed(data)
-        if pipe.close():
-            error(f'Cannot retrieve file list at %{url}')
-    htmlp.close()
+    data = spectree.retrieve_url(url)
+    if data is None:
+        error('Cannot retrieve file list at %s', url)
+        return []
+    body = data.decode('utf-8', errors='replace')
 
     # The first link points to the parent directory which we don't need
-    links = htmlp.links[1:]
+    links = [decode_href(href) for href in HREF_RE.findall(body)[1:]]
 
-    # Filter out all other directories
-    links = [link for link in links if not link.endswith('/') and not link.startswith('?')]
+    # Filter out all other directories and unwanted files
+    links = [link for link in links
+             if link.endswith(suffix) and not link.endswith('/') and not link.startswith('?')]
 
     return links
 
 
-def retrieve_all_packages(srpm_source: str) -> Tuple[Set[str], Dict[str, str]]:
+def retrieve_all_packages(srpm_source: str) -> Tuple[FrozenSet[str], Dict[str, str]]:
     '''Retrieve a list of all packages available in the distribution.
 
     This could be changed to use the urpmi synthesis files instead.
@@ -212,30 +328,27 @@ def retrieve_all_packages(srpm_source: str) -> Tuple[Set[str], Dict[str, str]]:
 
     for media in SRPM_MEDIAS:
         url = srpm_source.format(version=SRPM_VERSION, media=media, section=SRPM_SECTION)
+        # An empty listing is almost certainly a retrieval error, but one that
+        # merely has no RPMs in it is only worth a warning, so the filtering
+        # is done here rather than by retrieve_dir_contents()
         listing = retrieve_dir_contents(url)
         if not listing:
-            raise RuntimeError('Error retrieving listing from ' + url)
-
-        rpm_re = re.compile(r'^.*\.rpm$')
-        rpms = [f for f in listing if rpm_re.match(f)]
+            raise RuntimeError('Error retrieving package listing from ' + url)
+        rpms = [f for f in listing if f.endswith('.rpm')]
         if not rpms:
             error('Warning: No results from ' + url)
 
         info('%d packages found in media %s', len(rpms), media)
 
         for rpm in rpms:
-            package = package_name(rpm)
+            package, rpm_base = parse_rpm(rpm)
             if not package:
                 error('Cannot determine package name for ' + rpm)
                 continue
-            rpm_base = rpm_base_name(rpm)
-            if not rpm_base:
-                error('Cannot determine base name for ' + rpm)
-                continue
             all_packages[package] = rpm_base
             all_rpms.add(rpm_base)
 
-    return all_rpms, all_packages
+    return frozenset(all_rpms), all_packages
 
 
 def get_srpm_name_stub_from_spec(spec_file: str, release: str) -> str:
@@ -245,21 +358,43 @@ def get_srpm_name_stub_from_spec(spec_file: str, release: str) -> str:
     '''
     # %dist includes the mgaX version of the current machine by default, which
     # might not match that of release, so construct the version ourselves.
-    cmd = 'rpmspec -q -D"dist ."%s --queryformat "%%{NAME}-%%{VERSION}-%%{RELEASE}\n" -- %s' % \
-          (shlex.quote(release), shlex.quote(spec_file))
-    debug("Running: %s", cmd)
-    pipe = os.popen(cmd, 'r')
+    cmd = ['rpmspec', '-q', '-D', 'dist .' + release,
+           '--queryformat', '%{NAME}-%{VERSION}-%{RELEASE}\n', '--', spec_file]
+    debug("Running: %s", shlex.join(cmd))
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, text=True, check=False)
     # There may be many RPMs generated, but the first one is the one with the SRPM
-    line = pipe.readline()
+    line = proc.stdout.partition('\n')[0]
     if not line:
         return ''
-    _ = pipe.read()  # ignore the rest
-    if pipe.close():
+    if proc.returncode:
         error('Cannot parse spec file %s', spec_file)
         return ''
     return line.strip()
 
 
+def get_srpm_name_stubs_from_specs(spec_files: List[str], release: str) -> List[str]:
+    '''Determine the start of the SRPM names created by the given spec files.
+
+    This returns a list of names like 'foo-1.23-4' in the same order as
+    spec_files. All the files are parsed by a single rpmspec process. That
+    output can't be matched up with the spec files if any of them fails to
+    parse, so in that case each one is parsed on its own instead.
+    '''
+    # --srpm returns exactly one line per spec file, that of the SRPM
+    cmd = ['rpmspec', '-q', '--srpm', '-D', 'dist .' + release,
+           '--queryformat', '%{NAME}-%{VERSION}-%{RELEASE}\n', '--'] + spec_files
+    debug("Running: %s", shlex.join(cmd))
+    # Any errors are shown when the files are parsed individually
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True,
+                          check=False)
+    lines = proc.stdout.splitlines()
+    if not proc.returncode and len(lines) == len(spec_files):
+        return [line.strip() for line in lines]
+
+    debug('Batch parse failed; parsing %d spec files individually', len(spec_files))
+    return [get_srpm_name_stub_from_spec(spec_file, release) for spec_file in spec_files]
+
+
 @dataclass
 class PackageResult:
     '''Base class for the package result.'''
@@ -290,72 +425,189 @@ class VersionMismatch(PackageResult):
     '''Packages whose .spec file does not match the SRPM file on the server.'''
     base_name: str  # versioned name of srpm file on the server
     srpm_name: str  # versioned name of srpm file in the .spec file
+    have_ver: str  # version of srpm file on the server
+    have_distrib: str  # distro release of srpm file on the server
+    should_have_ver: str  # version of srpm file in the .spec file
+    should_have_distrib: str  # distro release of srpm file in the .spec file
+
+    def html_class(self) -> str:
+        '''Return the class attribute used to highlight this package in the HTML report.'''
+        if self.have_distrib != self.should_have_distrib:
+            return ' class="distrib"'
+        if self.have_ver == self.should_have_ver:
+            return ' class="release"'
+        return ''
 
 
 class ResultCollection:
-    '''Class holding the result of all package processing.'''
+    '''Class holding the result of all package processing.
+
+    Results are stored in a separate list for each result type so they can be
+    retrieved without scanning all the others.
+    '''
     def __init__(self):
-        self.result = []  # type: List[PackageResult]
-        self.sorted = True
+        self.result = {}  # type: Dict[Type[PackageResult], List[PackageResult]]
+        self.unsorted: Set[Type[PackageResult]] = set()
 
     def add(self, package: PackageResult):
         '''Add a new package to the collection.'''
-        self.result.append(package)
-        self.sorted = False
-
-    def _sort(self):
-        self.result.sort(key=lambda x: x.name)
-        self.sorted = True
+        result = type(package)
+        self.result.setdefault(result, []).append(package)
+        self.unsorted.add(result)
 
     def has_matching(self, result: Type[TypePackageResult]) -> bool:
         '''Returns True if any matching package is found.'''
-        return any(True for x in self.result if isinstance(x, result))
+        return bool(self.result.get(result))
+
+    def count(self, result: Type[PackageResult]) -> int:
+        '''Returns the number of matching packages.'''
+        return len(self.result.get(result, ()))
 
     def matching(self, result: Type[TypePackageResult]) -> List[TypePackageResult]:
         '''Returns list of matching packages in sorted order.'''
-        if not self.sorted:
-            self._sort()
-        return [x for x in self.result if isinstance(x, result)]
+        if result in self.unsorted:
+            self.result[result].sort(key=lambda x: x.name)
+            self.unsorted.discard(result)
+        # Return a copy so the caller can't change the collection
+        return list(self.result.get(result, []))
+
+
+class StubCache:
+    '''Persistent cache of the SRPM name stubs generated by spec files.
+
+    Entries are keyed on the spec file path and distro release and are only
+    used while the spec file's modification time is unchanged. Changes to the
+    RPM macros or to files included by a spec file are not detected.
+
+    The database is only accessed in load() and save(); lookup() and add() are
+    safe to call from worker threads.
+    '''
+    def __init__(self, path: str, release: str):
+        self.path = path
+        self.release = release
+        self.stubs = {}  # type: Dict[str, Tuple[int, str]]
+        self.new_stubs = {}  # type: Dict[str, Tuple[int, str]]
+
+    def _connect(self) -> sqlite3.Connection:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        db = sqlite3.connect(self.path)
+        db.execute('CREATE TABLE IF NOT EXISTS stubs (path TEXT, release TEXT, mtime INTEGER, '
+                   'stub TEXT, PRIMARY KEY (path, release))')
+        return db
+
+    def load(self):
+        '''Load the cached entries for this release.'''
+        try:
+            with contextlib.closing(self._connect()) as db:
+                self.stubs = {path: (mtime, stub) for path, mtime, stub in db.execute(
+                    'SELECT path, mtime, stub FROM stubs WHERE release = ?', (self.release,))}
+        except (OSError, sqlite3.Error) as e:
+            warning('Could not read cache %s: %s', self.path, e)
+        debug('%d cached SRPM names loaded', len(self.stubs))
+
+    def save(self):
+        '''Write all entries added since loading in a single transaction.'''
+        if not self.new_stubs:
+            return
+        try:
+            with contextlib.closing(self._connect()) as db, db:
+                db.executemany('INSERT OR REPLACE INTO stubs VALUES (?, ?, ?, ?)',
+                               ((path, self.release, mtime, stub)
+                                for path, (mtime, stub) in self.new_stubs.items()))
+        except (OSError, sqlite3.Error) as e:
+            warning('Could not write cache %s: %s', self.path, e)
+
+    def lookup(self, spec_path: str) -> Tuple[str, int]:
+        '''Return the cached stub for the spec file and the file's modification time.
+
+        The stub is '' if there is no valid entry and the time is 0 if the file
+        could not be accessed.
+        '''
+        path = os.path.abspath(spec_path)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return '', 0
+        entry = self.stubs.get(path)
+        if entry and entry[0] == mtime:
+            return entry[1], mtime
+        return '', mtime
+
+    def add(self, spec_path: str, mtime: int, stub: str):
+        '''Add an entry to be written by save().'''
+        if mtime and stub:
+            self.new_stubs[os.path.abspath(spec_path)] = (mtime, stub)
 
 
 class PackageProcessor:
     '''Class to analyze the versions of packages in .spec files.'''
 
-    def __init__(self, all_rpms: Set[str], all_packages: Dict[str, str], spec_style: int,
-                 release: str):
+    def __init__(self, all_rpms: FrozenSet[str], all_packages: Dict[str, str], spec_style: int,
+                 release: str, stub_cache: Optional[StubCache] = None):
         self.all_rpms = all_rpms
         self.all_packages = all_packages
         self.spec_style = spec_style
+        self.make_spec_path = spectree.specialize_make_spec_path(spec_style)
         self.release = release
+        self.stub_cache = stub_cache
         self.result = ResultCollection()
 
-    def process_package(self, package_file: str):
-        '''Process the given package.
+    def process_batch(self, package_files: List[str]) -> List[PackageResult]:
+        '''Process the given packages and return their results.
+
+        This method must be reentrant.
+        '''
+        results = []  # type: List[PackageResult]
+        packages = []
+        spec_paths = []
+        mtimes = []
+        for package_file in package_files:
+            package = os.path.basename(package_file)
+            if package not in self.all_packages:
+                results.append(NoSrpmFile(package))
+                continue
+            spec_path = self.make_spec_path(package_file)
+            if self.stub_cache:
+                srpm_name, mtime = self.stub_cache.lookup(spec_path)
+                if srpm_name:
+                    results.append(self.check_srpm_name(package, spec_path, srpm_name))
+                    continue
+                mtimes.append(mtime)
+            packages.append(package)
+            spec_paths.append(spec_path)
+        if not spec_paths:
+            return results
+
+        srpm_names = get_srpm_name_stubs_from_specs(spec_paths, self.release)
+        if self.stub_cache:
+            for spec_path, mtime, srpm_name in zip(spec_paths, mtimes, srpm_names):
+                self.stub_cache.add(spec_path, mtime, srpm_name)
+        for package, spec_path, srpm_name in zip(packages, spec_paths, srpm_names):
+            results.append(self.check_srpm_name(package, spec_path, srpm_name))
+        return results
+
+    def check_srpm_name(self, package: str, spec_path: str, srpm_name: str) -> PackageResult:
+        '''Compare the SRPM name generated by a package's spec file with the server.
 
         This method must be reentrant.
         '''
-        spec_path = spectree.make_spec_path(package_file, self.spec_style)
-        package = os.path.basename(package_file)
-        if package not in self.all_packages:
-            self.result.add(NoSrpmFile(package))
-            return
-        srpm_name = get_srpm_name_stub_from_spec(spec_path, self.release)
         if not srpm_name:
             error('Could not determine name stub for %s', spec_path)
-            self.result.add(ParseError(package))
-            return
+            return ParseError(package)
         # Some RPMs define distro_section which appends the section to the RPM
         # base name (e.g. lgeneral-1.2.3-3.mga5.nonfree). Strip this off before
         # using it so all names are canonical.
-        canon_srpm_name = rpm_base_name(srpm_name + '.src.rpm')
+        _, canon_srpm_name = parse_rpm(srpm_name + '.src.rpm')
         if not canon_srpm_name:
             error('Could not determine base name for %s.src.rpm', srpm_name)
-            self.result.add(ParseError(package))
-            return
+            return ParseError(package)
         if canon_srpm_name not in self.all_rpms:
-            self.result.add(VersionMismatch(package, self.all_packages[package], canon_srpm_name))
-            return
-        self.result.add(VersionMatch(package, canon_srpm_name))
+            base_name = self.all_packages[package]
+            _, have_ver, _, have_distrib = rpm_versions(base_name)
+            _, should_have_ver, _, should_have_distrib = rpm_versions(canon_srpm_name)
+            return VersionMismatch(package, base_name, canon_srpm_name, have_ver, have_distrib,
+                                   should_have_ver, should_have_distrib)
+        return VersionMatch(package, canon_srpm_name)
 
     def print_text_report(self, packagers: Dict[str, str]):
         '''Print a text report after all packages have been processed.'''
@@ -376,178 +628,105 @@ class PackageProcessor:
 
         print()
         print('Version match on server')
-        if len(self.result.matching(VersionMatch)) > 300:
+        if self.result.count(VersionMatch) > 300:
             print('%d spec files have matching RPMs (not shown)' %
-                  len(self.result.matching(VersionMatch)))
+                  self.result.count(VersionMatch))
         else:
             for package in self.result.matching(VersionMatch):
                 print(packagers[package.name], package.srpm_name)
 
     def print_html_report(self, packagers: Dict[str, str]):
         '''Print an HTML report after all packages have been processed.'''
-        print(HTML_HEADER)
-        print(f'<h1>{SRPM_VERSION} ({self.release}) Spec Build Report '
-              f'as of {time.strftime("%Y-%m-%d")}</h1>')
+        # Collect the report lines and write them out all at once at the end
+        out = []  # type: List[str]
+        out.append(HTML_HEADER)
+        out.append(f'<h1>{SRPM_VERSION} ({self.release}) Spec Build Report '
+                   f'as of {time.strftime("%Y-%m-%d")}</h1>')
 
         if self.result.has_matching(NoSrpmFile):
-            print('<a href="#no_rpm">Missing RPMs</a><br />')
+            out.append('<a href="#no_rpm">Missing RPMs</a><br />')
 
-        print('<a href="#wrong_version">Wrong RPM version</a><br />')
+        out.append('<a href="#wrong_version">Wrong RPM version</a><br />')
 
         if self.result.has_matching(ParseError):
-            print('<a href="#errors">Spec parsing errors</a><br />')
+            out.append('<a href="#errors">Spec parsing errors</a><br />')
 
         if self.result.has_matching(VersionMatch):
-            print('<a href="#match_version">Matching RPM versions</a><br />')
+            out.append('<a href="#match_version">Matching RPM versions</a><br />')
 
         if self.result.has_matching(NoSrpmFile):
-            print(textwrap.dedent(f'''
-                <a id="no_rpm"></a>
-                <h2>Spec files with no matching RPM of any version</h2>
-
-                There is no package SRPM in the {SRPM_VERSION} release matching the associated
-                .spec file. This may be because the package was imported but never
-                successfully built, or because the package has been obsoleted and
-                removed from the distribution but the .spec file was never moved to
-                packages/obsolete.
-                <p>({len(self.result.matching(NoSrpmFile))} packages)</p>
-                <!-- Extract the data in this table in CSV format with the command:
-                     xmlstarlet sel -N x=http://www.w3.org/1999/xhtml -t -m '//x:table[@id="norpms"]/x:tr[x:td]' -v 'x:td[2]' -o ',' -v 'x:td[1]' -nl
-                -->
-                <table id="norpms">
-                <tr>
-                  <th>Maintainer</th>
-                  <th>Package</th>
-                </tr>
-            '''))
+            out.append(HTML_NO_RPM_HEADER.format(version=SRPM_VERSION,
+                                                 count=self.result.count(NoSrpmFile)))
             for package in self.result.matching(NoSrpmFile):
-                url = SVNWEB_URL_TEMPLATE.format(version=SRPM_VERSION, package=escape(package.name))
-                print(textwrap.dedent(f'''
-                    <tr>
-                      <td>{escape(packagers[package.name])}</td>
-                      <td><a href="{url}">{escape(package.name)}</a></td>
-                    </tr>
-                '''))
-            print('</table>')
-
-        print(textwrap.dedent(f'''
-            <a id="wrong_version"></a>
-            <h2>Wrong RPM version</h2>
-
-            The latest version of the SRPM does not match the version in the .spec
-            file.  This may be because no-one has submitted the latest version to
-            be built, or because the last attempted build failed. This section will
-            be very large between the time a distro release is branched and the
-            first mass build of the next release version.
-            A package may also show up here as a false positive if it was
-            changed or built around the same time this report was generated.
-            <span class="release">Blue shaded lines</span> are packages with
-            equal versions but differ only in the release number.
-            <span class="distrib">Red shaded lines</span> are packages that
-            haven't been rebuilt since the last distribution release.
-            <p>({len(self.result.matching(VersionMismatch))} packages)</p>
-            <!-- Extract the data in this table in CSV format with the command:
-                 xmlstarlet sel -N x=http://www.w3.org/1999/xhtml -t -m '//x:table[@id="wrongversions"]/x:tr[x:td]' -v 'x:td[2]' -o ',' -v 'x:td[3]' -o ',' -v 'x:td[1]' -nl
-            -->
-            <table id="wrongversions">
-            <tr>
-              <th>Maintainer</th>
-              <th>RPM version</th>
-              <th>Spec version</th>
-            </tr>
-         '''))
-        for package in self.result.matching(VersionMismatch):
-            _, have_ver, _, have_distrib = rpm_versions(package.base_name)
-            _, should_have_ver, _, should_have_distrib = rpm_versions(package.srpm_name)
-            match_class = ''
-            if have_distrib != should_have_distrib:
-                match_class = ' class="distrib"'
-            elif have_ver == should_have_ver:
-                match_class = ' class="release"'
-            url = SVNWEB_URL_TEMPLATE.format(version=SRPM_VERSION, package=escape(package.name))
-            print(textwrap.dedent(f'''
-                    <tr{match_class}>
-                      <td>{escape(packagers[package.name])}</td>
-                      <td>{escape(package.base_name)}</td>
-                      <td><a href="{url}">{escape(package.srpm_name)}</a></td>
-                    </tr>
-                '''))
-        print('</table>')
+                name = escape(package.name)
+                out.append(HTML_NO_RPM_ROW.format(
+                    maintainer=escape(packagers[package.name]), url=svnweb_url(name), package=name))
+            out.append('</table>')
+
+        out.append(HTML_WRONG_VERSION_HEADER.format(count=self.result.count(VersionMismatch)))
+        out.extend(HTML_WRONG_VERSION_ROW.format(
+            match_class=package.html_class(),
+            maintainer=escape(packagers[package.name]),
+            base_name=escape(package.base_name),
+            url=svnweb_url(escape(package.name)),
+            srpm_name=escape(package.srpm_name))
+            for package in self.result.matching(VersionMismatch))
+        out.append('</table>')
 
         if self.result.has_matching(ParseError):
-            print(textwrap.dedent(f'''
-                <a id="errors"></a>
-                <h2>Could not determine version number from these packages</h2>
-
-                This could be due to a syntax error in the .spec file, a missing
-                %include file (such files are not normally available to this reporting
-                script so this is expected), a missing utility used in command
-                substitution (BuildRequires: are not normally available to this
-                reporting script so this is expected), a mismatch between the SVN
-                directory and the .spec file name, or an internal error in the script
-                generating this report.
-                <p>({len(self.result.matching(ParseError))} packages)</p>
-                <!-- Extract the data in this table in CSV format with the command:
-                     xmlstarlet sel -N x=http://www.w3.org/1999/xhtml -t -m '//x:table[@id="noversions"]/x:tr[x:td]' -v 'x:td[1]' -nl
-                -->
-                <table id="noversions">
-                <tr>
-                  <th>Package</th>
-                </tr>
-            '''))
+            out.append(HTML_PARSE_ERROR_HEADER.format(count=self.result.count(ParseError)))
             for package in self.result.matching(ParseError):
-                url = SVNWEB_URL_TEMPLATE.format(version=SRPM_VERSION, package=escape(package.name))
-                print(textwrap.dedent(f'''
-                    <tr>
-                      <td><a href="{url}">{escape(package.name)}</a></td>
-                    </tr>
-                '''))
-            print('</table>')
+                name = escape(package.name)
+                out.append(HTML_PARSE_ERROR_ROW.format(url=svnweb_url(name), package=name))
+            out.append('</table>')
 
         if self.result.has_matching(VersionMatch):
-            print('''
+            out.append('''
             <a id="match_version"></a>
             <h2>Spec &amp; RPM versions match</h2>
 
             The version of the SRPM matches the version in the .spec file. This is
             the desired state, so these are the only packages without error.
             ''')
-            if len(self.result.matching(VersionMatch)) > 300:
-                print('<p>%d spec files have matching RPMs (not shown)</p>' %
-                      len(self.result.matching(VersionMatch)))
+            if self.result.count(VersionMatch) > 300:
+                out.append('<p>%d spec files have matching RPMs (not shown)</p>' %
+                           self.result.count(VersionMatch))
             else:
-                print(textwrap.dedent(f'''
-                    <p>({len(self.result.matching(VersionMatch))} packages)</p>
-                    <!-- Extract the data in this table in CSV format with the command:
-                         xmlstarlet sel -N x=http://www.w3.org/1999/xhtml -t -m '//x:table[@id="matchingversions"]/x:tr[x:td]' -v 'x:td[2]' -o ',' -v 'x:td[1]' -nl
-                    -->
-                    <table id="matchingversions">
-                    <tr>
-                      <th>Maintainer</th>
-                      <th>Spec/RPM version</th>
-                    </tr>
-                '''))
-                for package in self.result.matching(VersionMatch):
-                    print(textwrap.dedent(f'''
-                        <tr>
-                          <td>{escape(packagers[package.name])}</td>
-                          <td>{escape(package.srpm_name)}</td>
-                        </tr>
-                    '''))
-                print('</table>')
-
-        print(HTML_FOOTER)
+                out.append(HTML_MATCH_VERSION_HEADER.format(count=self.result.count(VersionMatch)))
+                out.extend(HTML_MATCH_VERSION_ROW.format(maintainer=escape(packagers[package.name]),
+                                                         srpm_name=escape(package.srpm_name))
+                           for package in self.result.matching(VersionMatch))
+                out.append('</table>')
+
+        out.append(HTML_FOOTER)
+        print('\n'.join(out))
+
+
+def svnweb_url(package: str) -> str:
+    '''Return the SVNWEB_URL_TEMPLATE URL for the package name (already HTML escaped).'''
+    return SVNWEB_PACKAGE_URL_TEMPLATE.format(package=package)
 
 
 def process_packages(proc: PackageProcessor, spec_packages: List[str]):
-    '''Process the given packages with thread parallelism.'''
+    '''Process the given packages in batches with thread parallelism.
+
+    The results are all added to proc.result from this thread.
+    '''
+    batches = [spec_packages[i:i + SPEC_BATCH_SIZE]
+               for i in range(0, len(spec_packages), SPEC_BATCH_SIZE)]
+    total = len(spec_packages)
+    percent_per_package = 100 / total if total else 0
+    add = proc.result.add
     with concurrent.futures.ThreadPoolExecutor(max_workers=PARALLEL_THREADS) as executor:
-        futures = (executor.submit(proc.process_package, package) for package in spec_packages)
+        futures = {executor.submit(proc.process_batch, batch): len(batch) for batch in batches}
+        done = 0
         for n, future in enumerate(concurrent.futures.as_completed(futures)):
-            if n % 100 == 0:
+            for package in future.result():
+                add(package)
+            done += futures[future]
+            if n % 4 == 0:
                 # Provide some visual feedback on progress
-                info('%d/%d (%d%%)', n, len(spec_packages), 100 * n / len(spec_packages))
-            future.result()  # call this so reveal any exceptions
+                info('%d/%d (%d%%)', done, total, done * percent_per_package)
 
 
 class MgaReleaseTagAction(argparse.Action):
@@ -568,6 +747,9 @@ def main(argv: Optional[List[str]] = None) -> int:
     parser.add_argument(
         '-l', '--local_packages', default=spectree.LOCAL_PACKAGE_GLOB,
         help='Glob pointing to local .srpm packages')
+    parser.add_argument(
+        '-n', '--no_cache', action='store_true',
+        help='Parse every spec file instead of reusing SRPM names cached from previous runs.')
     parser.add_argument(
         '-r', '--release', type=str, default='mga' + SRPM_DISTRO_RELEASE,
         action=MgaReleaseTagAction,
@@ -598,7 +780,7 @@ def main(argv: Optional[List[str]] = None) -> int:
         fatal('No package directories found in %s', args.local_packages)
         return 1
 
-    spec_style = spectree.determine_spec_tree_style(args.local_packages)
+    spec_style = spectree.determine_spec_tree_style(args.local_packages, sample_path=spec_packages[-1])
     info('Spec file checkout style in use is %s',
          spectree.SPEC_STYLE_NAME[spec_style])
     if spec_style == spectree.SpecStyle.SPEC_STYLE_UNKNOWN:
@@ -619,13 +801,21 @@ def main(argv: Optional[List[str]] = None) -> int:
         warning('Packager list could not be retrieved. Packagers will not be shown.')
     info('%d packages+packagers known', len(packagers))
 
-    proc = PackageProcessor(all_rpms, all_packages, spec_style, args.release)
+    stub_cache = None
+    if not args.no_cache:
+        stub_cache = StubCache(STUB_CACHE_PATH, args.release)
+        stub_cache.load()
+
+    proc = PackageProcessor(all_rpms, all_packages, spec_style, args.release, stub_cache)
 
     info('Starting check of spec files')
     spec_packages.sort()
 
     process_packages(proc, spec_packages)
 
+    if stub_cache:
+        stub_cache.save()
+
     if args.text_report:
         proc.print_text_report(packagers)
     else:
@@ -16,19 +16,23 @@ TODO:
 
 import argparse
 import concurrent.futures
+import contextlib
 import enum
+import functools
 import logging
 import os
 import re
 import shlex
+import subprocess
 import sys
 import textwrap
 import time
 from dataclasses import dataclass
 from html import escape
 from logging import debug, error, fatal, info, warning
+from operator import attrgetter, itemgetter
 from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
-from urllib.parse import quote
+from urllib.parse import quote, urlsplit
 
 from spectree import spectree
 
@@ -36,24 +40,57 @@ from spectree import spectree
 # Match what looks like an actual URL
 URL_MATCH_RE = re.compile(r'([-+.a-zA-Z0-9]+)://')
 
+# URL schemes that can be checked
+HTTP_SCHEMES = frozenset(('http', 'https'))
+FTP_SCHEMES = frozenset(('ftp', 'ftps'))
+SUPPORTED_SCHEMES = HTTP_SCHEMES | FTP_SCHEMES
+
+# URL schemes that use encryption
+SECURE_SCHEMES = frozenset(('https', 'ftps'))
+
+# Response codes with special meanings
+HTTP_RATE_LIMIT_CODES = frozenset((423, 429))
+HTTP_AUTH_CODES = frozenset((401, 402, 403))
+FTP_VALID_CODES = frozenset((250, 257, 350))
+FTP_AUTH_CODES = frozenset((530, 430))
+FTP_ABORTED_CODES = frozenset((221, 230))
+
 # Parallelize spec parsing with a bit more than the number of available cores
 PARALLEL_SPEC_THREADS = int(1.5 * len(os.sched_getaffinity(0)))
 
 # Massively parallelize URL checking since this is normally bandwidth limited,
 # not CPU limited. But, keep this low enough so that servers don't throttle us,
-# especially SourceForge.
-PARALLEL_URL_THREADS = 5
+# especially SourceForge. Each thread runs a curl process that checks up to
+# URL_PARALLEL_TRANSFERS URLs at once, so the total number of URLs being
+# checked simultaneously is the product of the two.
+PARALLEL_URL_THREADS = 2
+
+# Maximum number of URLs checked at once by each curl process
+URL_PARALLEL_TRANSFERS = 3
 
 # Maximum number of URLs to check at a time. This is to improve efficiency by
-# checking several URLs in the same OS process and reusing the network
-# connection when possible.
-URL_BATCHES = 20
+# checking several URLs in the same OS process, which shares its DNS cache and
+# reuses network connections when possible. Since each process checks
+# URL_PARALLEL_TRANSFERS URLs at once, a slow URL doesn't hold up the rest of
+# its batch.
+URL_BATCHES = 50
 
 # Smallest batch size, used when the number of URLs to check is low. A minimum
 # larger than 1 can actually be faster since less connection setup needs to be
 # done when several URLs are checked on the same host.
 URL_BATCHES_MIN = 3
 
+# Maximum number of URLs on the same host to check consecutively. Some servers
+# throttle clients that make too many requests in a row.
+URL_HOST_RUN = 5
+
+# Fractional part of the golden ratio, used to stagger the runs of URLs from
+# different hosts
+GOLDEN_RATIO = 0.6180339887498949
+
+# curl exit code when the -m time limit is reached
+CURLE_OPERATION_TIMEDOUT = 28
+
 # Time in seconds to wait for each individual URL
 # An unfortunate situation results if this is >7, since SourceForge seems to
 # kill a connection at 7.6 seconds without responding, making it look to the
@@ -89,6 +126,77 @@ HTML_FOOTER = textwrap.dedent('''
 ''')
 
 
+HTML_SUMMARY = textwrap.dedent('''
+    {checked} URLs were checked<br />
+    {bad} URLs were bad<br />
+    {insecure} URLs were insecure<br />
+
+    <br />
+    <a href="#bad_urls">Bad URLs</a><br />
+    <a href="#insecure_urls">Insecure URLs</a><br />''')
+
+HTML_BAD_URL_HEADER = textwrap.dedent(r'''
+    <a id="bad_urls"></a>
+    <h2>Spec files with bad URLs</h2>
+    <!-- Extract the data in this table in CSV format with the command:
+         xmlstarlet sel -N x=http://www.w3.org/1999/xhtml -t -m '//x:table[@id="badurls"]/x:tr[x:td]' -v 'x:td[1]' -o ',' -v 'x:td[2]' -o ',' -v 'x:td[3]' -o ',' -v 'x:td[4]' -o ',' -v 'x:td[6]' -nl
+    -->
+    <table id="badurls" summary="Package URLs that were determined to be bad in some way along with ownership, use and additional information.">
+        <tr>
+          <th title="The registered maintainer of the package" class="shaded nowrap">Maintainer</th>
+          <th title="The package spec name" class="nowrap">Package</th>
+          <th title="Whether the URL was used for the package home page, a source or a patch" class="shaded nowrap">URL Use</th>
+          <th title="What went wrong when checking the URL" class="nowrap">Error</th>
+          <th title="Links to information sources regarding this package" class="shaded nowrap">Info</th>
+          <th title="The URL that was checked">URL</th>
+        </tr>''')
+
+# project_link and https_link are optional and must include their own leading
+# newline and indentation
+HTML_BAD_URL_ROW = textwrap.dedent('''
+    <tr>
+      <td class="shaded nowrap">{maintainer}</td>
+      <td class="nowrap">{package}</td>
+      <td class="shaded nowrap">{use}</td>
+      <td class="nowrap">{status}</td>
+      <td class="shaded nowrap">
+          <a href="https://svnweb.mageia.org/packages/cauldron/{quoted_package}/current/SPECS/{quoted_package}.spec?view=markup">SVN</a>
+          <a href="https://release-monitoring.org/projects/search/?pattern={quoted_package}">RM</a>
+          <a href="https://directory.fsf.org/wiki?search={quoted_package}">FSD</a>
+          <a href="https://web.archive.org/web/*/{url}">Arc</a>{project_link}{https_link}
+      </td>
+      <td><a href="{url}">{url}</a></td>
+    </tr>''')
+
+HTML_INSECURE_URL_HEADER = textwrap.dedent(r'''
+    <a id="insecure_urls"></a>
+    <h2>Spec files with insecure URLs</h2>
+    <!-- Extract the data in this table in CSV format with the command:
+         xmlstarlet sel -N x=http://www.w3.org/1999/xhtml -t -m '//x:table[@id="insecureurls"]/x:tr[x:td]' -v 'x:td[1]' -o ',' -v 'x:td[2]' -o ',' -v 'x:td[3]' -o ',' -v 'x:td[5]' -nl
+    -->
+    <table id="insecureurls" summary="Package URLs that point to unencrypted resources.">
+        <tr>
+          <th title="The registered maintainer of the package" class="shaded nowrap">Maintainer</th>
+          <th title="The package spec name" class="nowrap">Package</th>
+          <th title="Whether the URL was used for the package home page, a source or a patch" class="shaded nowrap">URL Use</th>
+          <th title="Links to information sources regarding this package" class="shaded nowrap">Info</th>
+          <th title="The URL in question">URL</th>
+        </tr>''')
+
+# project_link is optional and must include its own leading newline and
+# indentation
+HTML_INSECURE_URL_ROW = textwrap.dedent('''
+    <tr>
+      <td class="shaded nowrap">{maintainer}</td>
+      <td class="nowrap">{package}</td>
+      <td class="shaded nowrap">{use}</td>
+      <td class="shaded nowrap">{project_link}
+        <a href="https{https_url}">https</a>
+      </td>
+      <td><a href="{url}">{url}</a></td>
+    </tr>''')
+
+
 class UrlType(enum.IntEnum):
     '''What the URL is used for in the spec file'''
     URL = enum.auto()
@@ -130,6 +238,9 @@ URL_STATUS_NAME = {
     UrlStatus.TEMPORARY_ERR: 'Temporary server error'
 }
 
+# URL statuses that are checked a second time, following redirects
+RECHECK_STATUSES = frozenset((UrlStatus.REDIRECT, UrlStatus.TEMPORARY_ERR))
+
 
 @dataclass
 class UrlResult:
@@ -137,58 +248,102 @@ class UrlResult:
     name: str          # bare package name
     use: UrlType       # what the URL is for
     url: str           # syntactically-valid URL
+    scheme: str        # lower case URL scheme
     status: UrlStatus  # whether the URL works or not
 
 
-def get_urls_from_spec(spec_file: str) -> Set[str]:
-    '''Extracts the URL: fields defined in the given spec file.
+def url_scheme(url: str) -> str:
+    '''Return the lower case scheme of a syntactically-valid URL.
 
-    This returns zero or more syntactically-valid URLs in a set which de-dupes
-    them.
+    The URL must already have been matched by URL_MATCH_RE, so the scheme is
+    everything before the first ://. The result is interned since there are
+    only a few distinct schemes shared by a great many URLs.
     '''
-    cmd = (r"rpmspec -q --queryformat '%%{URL}\n' -- %s" %
-           shlex.quote(spec_file))
-    debug("Running: %s", cmd)
-    urls = set()
-    with os.popen(cmd, 'r') as pipe:
-        # There is one URL generated per package type
-        while line := pipe.readline():
-            # rpmspec returns (none) if no Url: line is found
-            if (url := line.strip()) and url != '(none)':
-                if URL_MATCH_RE.match(url):
-                    urls.add(url)
-                else:
-                    warning(f'Not a valid URL in spec file; skipping: {url}')
-        if pipe.close():
-            error('Cannot parse spec file %s', spec_file)
-    return urls
+    return sys.intern(url.partition('://')[0].lower())
+
+
+def url_host(url: str) -> str:
+    '''Return the lower case host name of a URL, or '' if it can't be determined.'''
+    try:
+        return urlsplit(url).hostname or ''
+    except ValueError:
+        return ''
+
+
+# Spec file section names, each starting with a line like "%name"
+SPEC_SECTIONS = frozenset((
+    'build', 'changelog', 'check', 'clean', 'conf', 'description', 'end', 'files',
+    'filetrigger', 'filetriggerin', 'filetriggerpostun', 'filetriggerun',
+    'generate_buildrequires', 'install', 'package', 'patchlist', 'post', 'postun',
+    'postuntrans', 'posttrans', 'pre', 'prep', 'pretrans', 'preun', 'preuntrans', 'sepolicy',
+    'sourcelist', 'transfiletrigger', 'transfiletriggerin', 'transfiletriggerpostun',
+    'transfiletriggerun', 'trigger', 'triggerin', 'triggerpostun', 'triggerprein', 'triggerun',
+    'verifyscript'))
+
+# Sections in which preamble tags are found
+SPEC_PREAMBLE_SECTIONS = frozenset(('', 'package'))
+
+# Match the start of a spec file section
+SPEC_SECTION_RE = re.compile(r'%([a-z_]+)\b')
 
+# Match a URL:, SourceN: or PatchN: tag in a spec file preamble
+SPEC_URL_TAG_RE = re.compile(r'\s*(url|source|patch)\d*\s*:\s*(.*)', re.IGNORECASE)
 
-def get_sources_from_spec(spec_file: str) -> Tuple[Set[str], Set[str]]:
-    '''Extracts the SourceN: and PatchN: lines defined in the given spec file.
 
-    This returns a tuple with a set of syntactically-valid source URLs and a
-    set of syntactically-valid patch URLs.
+def get_urls_from_spec(spec_file: str) -> Tuple[Set[str], Set[str], Set[str]]:
+    '''Extracts the URL:, SourceN: and PatchN: lines defined in the given spec file.
+
+    This returns a tuple with sets of syntactically-valid home page URLs,
+    source URLs and patch URLs, which de-dupes them. rpmspec is run once to
+    expand the macros and conditionals in the spec file and the tags are
+    picked out of its output, including the entries in any %sourcelist and
+    %patchlist sections.
     '''
-    cmd = r"spectool -- %s" % shlex.quote(spec_file)
-    debug("Running: %s", cmd)
+    cmd = ['rpmspec', '-P', '--', spec_file]
+    debug("Running: %s", shlex.join(cmd))
+    urls = set()
     sources = set()
     patches = set()
-    with os.popen(cmd, 'r') as pipe:
-        # There is one URL generated per package type
-        while line := pipe.readline():
-            key, url = line.strip().split(maxsplit=1)
-            if key.lower().startswith('source'):
+    section = ''
+    # The output includes free text like %description which isn't necessarily
+    # valid UTF-8, so don't let a bad byte there abort the whole run
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE, encoding='utf-8', errors='replace') as proc:
+        for line in proc.stdout:
+            if line.startswith('%'):
+                if (m := SPEC_SECTION_RE.match(line)) and m.group(1) in SPEC_SECTIONS:
+                    section = m.group(1)
+                continue
+
+            if section in SPEC_PREAMBLE_SECTIONS:
+                if not (m := SPEC_URL_TAG_RE.match(line)):
+                    continue
+                tag = m.group(1).lower()
+                url = m.group(2).strip()
+            elif section == 'sourcelist':
+                tag = 'source'
+                url = line.strip()
+            elif section == 'patchlist':
+                tag = 'patch'
+                url = line.strip()
+            else:
+                continue
+
+            if not url:
+                continue
+            if tag == 'url':
                 if URL_MATCH_RE.match(url):
+                    urls.add(url)
+                else:
+                    warning(f'Not a valid URL in spec file; skipping: {url}')
+            elif URL_MATCH_RE.match(url):
+                if tag == 'source':
                     sources.add(url)
-            elif key.lower().startswith('patch'):
-                if URL_MATCH_RE.match(url):
+                else:
                     patches.add(url)
-            else:
-                info('Not a source or patch type: %s', key)
-        if pipe.close():
-            error('Cannot parse spec file %s', spec_file)
-    return (sources, patches)
+
+    if proc.returncode:
+        error('Cannot parse spec file %s', spec_file)
+    return (urls, sources, patches)
 
 
 class PackageProcessor:
@@ -196,23 +351,28 @@ class PackageProcessor:
 
     def __init__(self, spec_style: int):
         self.spec_style = spec_style
+        self.make_spec_path = spectree.specialize_make_spec_path(spec_style)
         self.result = []  # type: List[UrlResult]
 
-    def process_package(self, package_file: str):
+    def process_package(self, package_file: str) -> List[UrlResult]:
         '''Process the spec files to extract URLs.
 
-        This method must be thread safe.
+        The results are returned rather than added to self.result so this
+        method doesn't touch any shared state and is reentrant.
         '''
-        spec_path = spectree.make_spec_path(package_file, self.spec_style)
-        urls = get_urls_from_spec(spec_path)
+        spec_path = self.make_spec_path(package_file)
+        urls, sources, patches = get_urls_from_spec(spec_path)
+        results = []  # type: List[UrlResult]
         for url in urls:
-            self.result.append(UrlResult(package_file, UrlType.URL, url, UrlStatus.UNCHECKED))
-
-        sources, patches = get_sources_from_spec(spec_path)
+            results.append(UrlResult(package_file, UrlType.URL, url, url_scheme(url),
+                                     UrlStatus.UNCHECKED))
         for url in sources:
-            self.result.append(UrlResult(package_file, UrlType.SOURCE, url, UrlStatus.UNCHECKED))
+            results.append(UrlResult(package_file, UrlType.SOURCE, url, url_scheme(url),
+                                     UrlStatus.UNCHECKED))
         for url in patches:
-            self.result.append(UrlResult(package_file, UrlType.PATCH, url, UrlStatus.UNCHECKED))
+            results.append(UrlResult(package_file, UrlType.PATCH, url, url_scheme(url),
+                                     UrlStatus.UNCHECKED))
+        return results
 
     def update_url_status(self, statuses: Dict[str, UrlStatus]):
         '''Update each url result with its status'''
@@ -234,7 +394,7 @@ class PackageProcessor:
     def print_text_report(self, packagers: Dict[str, str]):
         '''Print a text report after all URLs have been processed.'''
         # Sort on name, use, url
-        self.result.sort(key=lambda x: f'{x.name}|{int(x.use)}|{x.url}')
+        self.result.sort(key=attrgetter('name', 'use', 'url'))
         # The text report just dumps everything for all URLs
         for specurl in self.result:
             print(packagers[specurl.name], specurl.name, specurl.use, specurl.status, specurl.url)
@@ -242,113 +402,79 @@ class PackageProcessor:
     def print_html_report(self, packagers: Dict[str, str]):
         '''Print a HTML report after all URLs have been processed.'''
         # Sort on name, use, url
-        self.result.sort(key=lambda x: f'{x.name}|{int(x.use)}|{x.url}')
-        print(HTML_HEADER)
-        print(f'<h1>Spec URL Check Report as of {time.strftime("%Y-%m-%d")}</h1>')
-        print(textwrap.dedent(f'''
-            {len(self.result)} URLs were checked<br />
-            {len([x for x in self.result
-                    if x.status != UrlStatus.VALID])} URLs were bad<br />
-            {len([x for x in self.result
-                    if URL_MATCH_RE.match(x.url).group(1).lower()
-                       not in ('https', 'ftps')])} URLs were insecure<br />'''))
-
-        print(textwrap.dedent('''
-            <br />
-            <a href="#bad_urls">Bad URLs</a><br />
-            <a href="#insecure_urls">Insecure URLs</a><br />'''))
-
-        # Build a hash table of project URLs for quick access
-        home_pages = {entry.name: entry.url for entry in self.result if entry.use == UrlType.URL}
-
-        print(textwrap.dedent(r'''
-            <a id="bad_urls"></a>
-            <h2>Spec files with bad URLs</h2>
-            <!-- Extract the data in this table in CSV format with the command:
-                 xmlstarlet sel -N x=http://www.w3.org/1999/xhtml -t -m '//x:table[@id="badurls"]/x:tr[x:td]' -v 'x:td[1]' -o ',' -v 'x:td[2]' -o ',' -v 'x:td[3]' -o ',' -v 'x:td[4]' -o ',' -v 'x:td[6]' -nl
-            -->
-            <table id="badurls" summary="Package URLs that were determined to be bad in some way along with ownership, use and additional information.">
-                <tr>
-                  <th title="The registered maintainer of the package" class="shaded nowrap">Maintainer</th>
-                  <th title="The package spec name" class="nowrap">Package</th>
-                  <th title="Whether the URL was used for the package home page, a source or a patch" class="shaded nowrap">URL Use</th>
-                  <th title="What went wrong when checking the URL" class="nowrap">Error</th>
-                  <th title="Links to information sources regarding this package" class="shaded nowrap">Info</th>
-                  <th title="The URL that was checked">URL</th>
-                </tr>'''))
+        self.result.sort(key=attrgetter('name', 'use', 'url'))
+        # Collect the report lines and write them out all at once at the end
+        out = []  # type: List[str]
+        out.append(HTML_HEADER)
+        out.append(f'<h1>Spec URL Check Report as of {time.strftime("%Y-%m-%d")}</h1>')
+
+        # Count the bad and insecure URLs in a single pass
+        bad = insecure = 0
+        for specurl in self.result:
+            if specurl.status != UrlStatus.VALID:
+                bad += 1
+            if specurl.scheme not in SECURE_SCHEMES:
+                insecure += 1
+        out.append(HTML_SUMMARY.format(checked=len(self.result), bad=bad, insecure=insecure))
+
+        # Build a hash table of escaped project URLs for quick access
+        home_pages = {entry.name: escape(entry.url) for entry in self.result if entry.use == UrlType.URL}
+
+        # Each package name and packager is needed HTML escaped (and the name
+        # URL quoted) in many rows, so convert them once per package
+        names = {entry.name for entry in self.result}
+        escaped_names = {name: escape(name) for name in names}
+        quoted_names = {name: quote(name) for name in names}
+        escaped_packagers = {name: escape(packagers[name]) for name in names}
+
+        out.append(HTML_BAD_URL_HEADER)
 
         for specurl in self.result:
 
             if specurl.status == UrlStatus.VALID:
                 continue
 
-            if URL_MATCH_RE.match(specurl.url).group(1).lower() != 'https':
-                https_link = f'<a href="https{escape(specurl.url[specurl.url.find(":"):])}">https</a>'
+            # Escaping never changes the scheme, so the escaped URL can be
+            # split to make the https version
+            url = escape(specurl.url)
+            if specurl.scheme != 'https':
+                https_link = f'\n      <a href="https{url[url.find(":"):]}">https</a>'
             else:
                 https_link = ''
 
             if specurl.use != UrlType.URL and specurl.name in home_pages:
-                project_link = f'<a href="{escape(home_pages[specurl.name])}">home</a>'
+                project_link = f'\n      <a href="{home_pages[specurl.name]}">home</a>'
             else:
                 project_link = ''
 
-            print(textwrap.dedent(f'''
-                <tr>
-                  <td class="shaded nowrap">{escape(packagers[specurl.name])}</td>
-                  <td class="nowrap">{escape(specurl.name)}</td>
-                  <td class="shaded nowrap">{URL_TYPE_NAME[specurl.use]}</td>
-                  <td class="nowrap">{URL_STATUS_NAME[specurl.status]}</td>
-                  <td class="shaded nowrap">
-                      <a href="https://svnweb.mageia.org/packages/cauldron/{quote(specurl.name)}/current/SPECS/{quote(specurl.name)}.spec?view=markup">SVN</a>
-                      <a href="https://release-monitoring.org/projects/search/?pattern={quote(specurl.name)}">RM</a>
-                      <a href="https://directory.fsf.org/wiki?search={quote(specurl.name)}">FSD</a>
-                      <a href="https://web.archive.org/web/*/{escape(specurl.url)}">Arc</a>
-                      {project_link}
-                      {https_link}
-                  </td>
-                  <td><a href="{escape(specurl.url)}">{escape(specurl.url)}</a></td>
-                </tr>'''))
-        print('</table>')
-
-        print(textwrap.dedent(r'''
-            <a id="insecure_urls"></a>
-            <h2>Spec files with insecure URLs</h2>
-            <!-- Extract the data in this table in CSV format with the command:
-                 xmlstarlet sel -N x=http://www.w3.org/1999/xhtml -t -m '//x:table[@id="insecureurls"]/x:tr[x:td]' -v 'x:td[1]' -o ',' -v 'x:td[2]' -o ',' -v 'x:td[3]' -o ',' -v 'x:td[5]' -nl
-            -->
-            <table id="insecureurls" summary="Package URLs that point to unencrypted resources.">
-                <tr>
-                  <th title="The registered maintainer of the package" class="shaded nowrap">Maintainer</th>
-                  <th title="The package spec name" class="nowrap">Package</th>
-                  <th title="Whether the URL was used for the package home page, a source or a patch" class="shaded nowrap">URL Use</th>
-                  <th title="Links to information sources regarding this package" class="shaded nowrap">Info</th>
-                  <th title="The URL in question">URL</th>
-                </tr>'''))
+            out.append(HTML_BAD_URL_ROW.format(
+                maintainer=escaped_packagers[specurl.name], package=escaped_names[specurl.name],
+                use=URL_TYPE_NAME[specurl.use], status=URL_STATUS_NAME[specurl.status],
+                quoted_package=quoted_names[specurl.name], url=url,
+                project_link=project_link, https_link=https_link))
+        out.append('</table>')
+
+        out.append(HTML_INSECURE_URL_HEADER)
 
         for specurl in self.result:
 
-            if URL_MATCH_RE.match(specurl.url).group(1).lower() in frozenset(('https', 'ftps')):
+            if specurl.scheme in SECURE_SCHEMES:
                 continue
 
             if specurl.use != UrlType.URL and specurl.name in home_pages:
-                project_link = f'<a href="{escape(home_pages[specurl.name])}">home</a>'
+                project_link = f'\n    <a href="{home_pages[specurl.name]}">home</a>'
             else:
                 project_link = ''
 
-            print(textwrap.dedent(f'''
-                <tr>
-                  <td class="shaded nowrap">{escape(packagers[specurl.name])}</td>
-                  <td class="nowrap">{escape(specurl.name)}</td>
-                  <td class="shaded nowrap">{URL_TYPE_NAME[specurl.use]}</td>
-                  <td class="shaded nowrap">
-                    {project_link}
-                    <a href="https{escape(specurl.url[specurl.url.find(":"):])}">https</a>
-                  </td>
-                  <td><a href="{escape(specurl.url)}">{escape(specurl.url)}</a></td>
-                </tr>'''))
-        print('</table>')
+            url = escape(specurl.url)
+            out.append(HTML_INSECURE_URL_ROW.format(
+                maintainer=escaped_packagers[specurl.name], package=escaped_names[specurl.name],
+                use=URL_TYPE_NAME[specurl.use], project_link=project_link,
+                https_url=url[url.find(':'):], url=url))
+        out.append('</table>')
 
-        print(HTML_FOOTER)
+        out.append(HTML_FOOTER)
+        print('\n'.join(out))
 
 
 def process_packages(proc: PackageProcessor, spec_packages: List[str]):
@@ -359,42 +485,45 @@ def process_packages(proc: PackageProcessor, spec_packages: List[str]):
             if n % 100 == 0:
                 # Provide some visual feedback on progress
                 info('%d/%d (%d%%)', n, len(spec_packages), 100 * n / len(spec_packages))
-            future.result()  # call this to reveal any exceptions
+            # This also reveals any exceptions
+            proc.result.extend(future.result())
+
 
+def process_urls(checker: Callable, batches: List[List[str]], redirect: bool,
+                 executor: Optional[concurrent.futures.Executor] = None) -> Dict[str, UrlStatus]:
+    '''Process the given packages in batches with thread parallelism.
 
-def process_urls(checker: Callable, batches: List[Set[str]],
-                 redirect: bool) -> Dict[str, UrlStatus]:
-    '''Process the given packages in batches with thread parallelism.'''
+    executor - executor to run the batches in, or None to create a new one
+    '''
 
     total_urls = sum(len(b) for b in batches)
-    url_results = {}
-    with concurrent.futures.ThreadPoolExecutor(max_workers=PARALLEL_URL_THREADS) as executor:
+    url_results = {}  # type: Dict[str, UrlStatus]
+    with (contextlib.nullcontext(executor) if executor
+          else concurrent.futures.ThreadPoolExecutor(max_workers=PARALLEL_URL_THREADS)) as executor:
         futures = (executor.submit(checker, package, redirect) for package in batches)
         for n, future in enumerate(concurrent.futures.as_completed(futures)):
             result = future.result()  # call this to reveal any exceptions
-            # TODO: for Python>=3.9 use | syntax to merge dicts
-            url_results = {**url_results, **result}
+            url_results.update(result)
             if n % 4 == 0:
                 # Provide some visual feedback on progress
                 info('%d/%d (%d%%)', len(url_results), total_urls, 100 * len(url_results) / total_urls)
     return url_results
 
 
-def status_from_response_code(response_code: int, url: str) -> UrlStatus:
-    '''Return a URL status give the URL and response code
+def status_from_response_code(response_code: int, url: str, scheme: str) -> UrlStatus:
+    '''Return a URL status give the URL, its scheme and response code
 
     Response codes for different URL schemes use different namespaces, and
     they're sorted out here.
     '''
     status = UrlStatus.UNSUPPORTED
-    scheme = URL_MATCH_RE.match(url).group(1).lower()
-    if scheme in frozenset(('http', 'https')):
+    if scheme in HTTP_SCHEMES:
         if 200 <= response_code < 300:
             status = UrlStatus.VALID
-        elif response_code in frozenset((423, 429)):
+        elif response_code in HTTP_RATE_LIMIT_CODES:
             # Rate limiting response
             status = UrlStatus.TEMPORARY_ERR
-        elif response_code in frozenset((401, 402, 403)):
+        elif response_code in HTTP_AUTH_CODES:
             status = UrlStatus.AUTHENTICATE
         elif 300 <= response_code < 400:
             status = UrlStatus.REDIRECT
@@ -404,12 +533,12 @@ def status_from_response_code(response_code: int, url: str) -> UrlStatus:
             status = UrlStatus.TEMPORARY_ERR
         else:
             error('Unknown HTTP error reason for %s', url)
-    elif scheme in frozenset(('ftp', 'ftps')):
-        if response_code in frozenset((250, 257, 350)):
+    elif scheme in FTP_SCHEMES:
+        if response_code in FTP_VALID_CODES:
             status = UrlStatus.VALID
-        elif response_code in frozenset((530, 430)):
+        elif response_code in FTP_AUTH_CODES:
             status = UrlStatus.AUTHENTICATE
-        elif response_code in frozenset((221, 230)):
+        elif response_code in FTP_ABORTED_CODES:
             # These can happen if the connection is terminated
             # by timeout before the end
             status = UrlStatus.TEMPORARY_ERR
@@ -422,21 +551,36 @@ def status_from_response_code(response_code: int, url: str) -> UrlStatus:
     return status
 
 
-def get_curl_timeout_factor() -> int:
+@functools.lru_cache(maxsize=None)
+def get_curl_version() -> Tuple[int, ...]:
+    '''Return the version of curl as a tuple of ints, or an empty tuple if unknown
+
+    The result is cached since it won't change during a run.
+    '''
+    cmd = ['curl', '-V']
+    try:
+        output = subprocess.run(cmd, stdout=subprocess.PIPE, text=True, check=False).stdout
+    except OSError as e:
+        error('Cannot run curl: %s', e)
+        return ()
+    parts = output.split(maxsplit=2)
+    try:
+        # Strip any suffix like -DEV
+        return tuple(int(n) for n in parts[1].split('-')[0].split('.'))
+    except (IndexError, ValueError):
+        return ()
+
+
+def get_curl_timeout_factor(curl_version: Tuple[int, ...]) -> int:
     '''Determine what units curl returns for timeouts'''
-    cmd = 'curl -V'
-    with os.popen(cmd, 'r') as pipe:
-        line = pipe.readline()
-        if line:
-            parts = line.split(maxsplit=3)
-            if len(parts) >= 2 and parts[1] == '7.74.0':
-                # This version of curl had a bug that returned microseconds
-                # instead of seconds
-                return 1
+    if curl_version == (7, 74, 0):
+        # This version of curl had a bug that returned microseconds
+        # instead of seconds
+        return 1
     return 1000000
 
 
-def check_url_batch(batch: Set[str], redirect: bool) -> Dict[str, UrlStatus]:
+def check_url_batch(batch: List[str], redirect: bool) -> Dict[str, UrlStatus]:
     '''Check a batch of URLs
 
     redirect - True to follow redirects
@@ -445,67 +589,144 @@ def check_url_batch(batch: Set[str], redirect: bool) -> Dict[str, UrlStatus]:
     results = {}
     debug(f'checking batch of {len(batch)} URLs')
 
-    # We must order the URLs so we can associate the results with the original
-    # URL since they aren't available in unmodified form from curl
-    urls = list(batch)
-    urls.sort()
+    # The results are associated with the original URLs by their position in
+    # this list, since they aren't available in unmodified form from curl
+    urls = batch
 
     timeout = URL_TIMEOUT_REDIRECT if redirect else URL_TIMEOUT
-    timeout_factor = get_curl_timeout_factor()
+    curl_version = get_curl_version()
+    timeout_factor = get_curl_timeout_factor(curl_version)
 
-    # Can't use --parallel here because the output lines from several URLs
-    # can (probably) get interleaved, and we can't associate the ordered
-    # results with the original URL. Parallelism is done at a higher level,
-    # using threads instead.
-    # The ||true at the end guarantees a 0 exit code, even if some URLs failed.
+    # curl is run directly rather than through a shell. Its exit code is
+    # ignored since it is nonzero whenever the last URL fails.
     # url_effective is only used for debugging
-    cmd = f"curl --ssl -s -m {timeout} -I {'-L --max-redirs 10' if redirect else ''} --ftp-method singlecwd --write-out '%{{response_code}} %{{ssl_verify_result}} %{{time_connect}} %{{time_total}} %{{num_connects}} %{{url_effective}}\\n' -o /dev/null {' -o /dev/null '.join(shlex.quote(url) for url in urls)} || true"
-    debug("Running: %s", cmd)
-    with os.popen(cmd, 'r') as pipe:
-        while line := pipe.readline():
-            debug('RESULTS: %s', line.strip())
-            # curl 7.74.0 returned microseconds instead of seconds.
-            # This will need to be updated to work on that version.
-            response_code, ssl_verify_result, time_connect, time_total, num_connects, _ = line.strip().split(maxsplit=5)
-            response_code, ssl_verify_result, time_connect, time_total, num_connects = (
-                int(response_code), int(ssl_verify_result), int(float(time_connect) * timeout_factor), int(float(time_total) * timeout_factor), int(num_connects))
-            # Get the URL corresponding to this result
-            url = urls.pop(0)
-
-            # We don't get the CURLcode result, so we need to infer the
-            # reason based on some other codes. That sometimes goes wrong
-            # (especially when handling redirects) but it's still going to show
-            # an error of some sort.
-            # TODO: This is fixed in curl 7.75.0 with the addition of %{exitcode}
-            status = UrlStatus.UNSUPPORTED
-            if time_total >= timeout*1000000*.99:
-                # Total time is no more than 1% less than the timeout
-                # This trumps everything else, because we can't trust the
-                # codes if curl aborts in the middle of a transfer
-                status = UrlStatus.TIMEOUT
-            elif ssl_verify_result:
-                status = UrlStatus.BAD_CERTIFICATE
-            elif response_code == 0:
-                if time_connect == 0 and num_connects == 0:
-                    # This is just a guess
-                    status = UrlStatus.BAD_HOST
-                else:
-                    error('Unknown error reason for %s', url)
+    write_out = '%{response_code} %{ssl_verify_result} %{time_connect} %{time_total} %{num_connects} %{url_effective}\n'
+    cmd = ['curl', '--ssl', '-s', '-m', str(timeout), '-I']
+    if redirect:
+        cmd += ['-L', '--max-redirs', '10']
+    # The results of parallel transfers come out in the order they finish, so
+    # each line is prefixed with the index of its URL. Older versions of curl
+    # can't do that, so the URLs are checked one at a time in order.
+    # --parallel-immediate is deliberately not used: it would open a new
+    # connection for every transfer to the same host instead of waiting to
+    # reuse or multiplex the first one, which is exactly the per-host load
+    # that grouping URLs by host is meant to avoid. The catch is that the -m
+    # timers of the transfers being held back are already running, so behind
+    # a slow URL they can time out without ever starting. The curl exit code
+    # (also new in 7.75.0) is included to detect that case.
+    parallel = curl_version >= (7, 75, 0)
+    if parallel:
+        cmd += ['--parallel', '--parallel-max', str(URL_PARALLEL_TRANSFERS), '--no-progress-meter']
+        write_out = '%{urlnum} %{exitcode} ' + write_out
+    cmd += ['--ftp-method', 'singlecwd', '--write-out', write_out]
+    for url in urls:
+        cmd += ['-o', '/dev/null', '--url', url]
+    debug("Running: %s", shlex.join(cmd))
+    output = subprocess.run(cmd, stdout=subprocess.PIPE, text=True, check=False).stdout
+
+    # Total time no more than 1% less than the timeout, in the units curl uses
+    timeout_limit = timeout * 1000000 * .99 / timeout_factor
+
+    for n, line in enumerate(output.splitlines()):
+        debug('RESULTS: %s', line)
+        fields = line.split(maxsplit=7 if parallel else 5)
+        exit_code = 0
+        if parallel:
+            n = int(fields.pop(0))
+            exit_code = int(fields.pop(0))
+        response_code, ssl_verify_result, time_connect, time_total, num_connects, _ = fields
+        # Get the URL corresponding to this result
+        url = urls[n]
+
+        # We don't get the CURLcode result, so we need to infer the
+        # reason based on some other codes. That sometimes goes wrong
+        # (especially when handling redirects) but it's still going to show
+        # an error of some sort. The exit code is only used to catch held
+        # back parallel transfers; otherwise the same inference is used for
+        # both paths so that older curl versions give the same results.
+        status = UrlStatus.UNSUPPORTED
+        code = int(response_code)
+        if float(time_total) >= timeout_limit:
+            # This trumps everything else, because we can't trust the
+            # codes if curl aborts in the middle of a transfer
+            status = UrlStatus.TIMEOUT
+        elif exit_code == CURLE_OPERATION_TIMEDOUT:
+            # curl held this transfer back waiting on another one to the same
+            # host and the timeout expired before it could start. This says
+            # nothing about the URL, so have it checked again later.
+            status = UrlStatus.TEMPORARY_ERR
+        elif int(ssl_verify_result):
+            status = UrlStatus.BAD_CERTIFICATE
+        elif code == 0:
+            if float(time_connect) == 0 and int(num_connects) == 0:
+                # This is just a guess
+                status = UrlStatus.BAD_HOST
             else:
-                status = status_from_response_code(response_code, url)
+                error('Unknown error reason for %s', url)
+        else:
+            status = status_from_response_code(code, url, url_scheme(url))
 
-            results[url] = status
+        results[url] = status
 
-        if pipe.close():
-            error('Cannot check URL batch')
+    if len(results) < len(urls):
+        error('Cannot check URL batch')
 
     return results
 
 
-def check_urls(urls: Iterable[str], redirect: bool = False) -> Dict[str, UrlStatus]:
+def interleave_host_runs(urls: List[str], run_size: int) -> List[str]:
+    '''Reorder the URLs so that requests to each host are spread out.
+
+    Putting requests to the same server together in a batch lets them take
+    advantage of a persistent network connection to that server.
+    Unfortunately, some servers (e.g. github.com and sourceforge.net) are in
+    thousands of URLs and start throwing rate-limiting 429 responses after
+    too many requests in a row (too many looks like about 70 for
+    sourceforge.net and 700 for github.com).
+
+    So, the URLs for each host are split into runs of no more than run_size,
+    and each run is given a position between 0 and 1 in the check. A host
+    with n runs has its runs at (i + offset) / n for i = 0..n-1, that is,
+    exactly 1/n of the check apart. The more runs a host has the closer they
+    are, but every other host's runs are spread over the whole check in the
+    same way, so they fill in the gaps. The runs are then sorted by position.
+
+    If every host started at the same offset, all the hosts with one run would
+    be put together at the same position, as would the first runs of all the
+    hosts with two, and so on. That would leave long stretches of large hosts
+    only. The offset is therefore different for each host: the fractional
+    part of host_num * the golden ratio. Successive multiples of the golden
+    ratio fill the interval [0, 1) more evenly than any other step, so the
+    offsets stay well spread for any number of hosts.
+
+    A plain round-robin over the hosts would run out of the smaller hosts
+    early and leave only the largest ones back to back at the end.
+    '''
+    by_host = {}  # type: Dict[str, List[str]]
+    for url in urls:
+        by_host.setdefault(url_host(url), []).append(url)
+    positioned_runs = []  # type: List[Tuple[float, List[str]]]
+    for host_num, host_urls in enumerate(by_host.values()):
+        offset = (host_num * GOLDEN_RATIO) % 1
+        num_runs = (len(host_urls) + run_size - 1) // run_size
+        positioned_runs.extend(((n + offset) / num_runs, host_urls[n * run_size:(n + 1) * run_size])
+                               for n in range(num_runs))
+    # The sort is stable, so runs at the same position stay in host order
+    positioned_runs.sort(key=itemgetter(0))
+    interleaved = [url for _, run in positioned_runs for url in run]
+
+    # Every URL must still be checked exactly once
+    if len(interleaved) != len(urls) or set(interleaved) != set(urls):
+        error('URLs were lost or duplicated while interleaving hosts')
+    return interleaved
+
+
+def check_urls(urls: Iterable[str], redirect: bool = False,
+               executor: Optional[concurrent.futures.Executor] = None) -> Dict[str, UrlStatus]:
     '''Check each URL to see if it's valid.
 
     redirect - True to follow redirects
+    executor - executor to run the checks in, or None to create a new one
 
     Do this in parallel for speed.'''
     all_urls = []
@@ -514,8 +735,7 @@ def check_urls(urls: Iterable[str], redirect: bool = False) -> Dict[str, UrlStat
             warning(f'Not a valid URL; skipping: {url}')
             # Not an actual URL; skip it & drop it from the results
             continue
-        if m.group(1).lower() not in frozenset(
-                ('http', 'https', 'ftp', 'ftps')):
+        if m.group(1).lower() not in SUPPORTED_SCHEMES:
             warning(f'Not a supported URL; skipping: {url}')
             # Unsupported URL; skip it & drop it from the results
             continue
@@ -526,30 +746,10 @@ def check_urls(urls: Iterable[str], redirect: bool = False) -> Dict[str, UrlStat
     batch_size = (URL_BATCHES if len(all_urls) >= URL_BATCHES*PARALLEL_URL_THREADS
                   else max(int(len(all_urls)/PARALLEL_URL_THREADS), URL_BATCHES_MIN))
 
-    # Sorting provides the nice property that requests to the same server
-    # would be batched together and could take advantage of a persistent
-    # network connection to the same server. Unfortunately, some servers (e.g.
-    # github.com and sourceforge.net) are in thousands of URLs and start
-    # throwing rate-limiting 429 responses after too many requests in a row
-    # (too many looks like about 70 for sourceforge.net and 700 for
-    # github.com). By not sorting, we rely on the pseudo-random ordering that
-    # a set provides which should distribute requests from many servers into
-    # a batch and slow down the number of requests to any given server. If the
-    # number of requests is small, sort anyway because it won't make any real
-    # difference to the rate of requests.
-    if len(all_urls) < 100:
-        all_urls.sort()
-
-    batches = []
-    while all_urls:
-        batch = set()
-        for _ in range(batch_size):
-            if not all_urls:
-                break
-            batch.add(all_urls.pop(0))
-        batches.append(batch)
-
-    return process_urls(check_url_batch, batches, redirect)
+    all_urls = interleave_host_runs(all_urls, min(URL_HOST_RUN, batch_size))
+    batches = [all_urls[i:i + batch_size] for i in range(0, len(all_urls), batch_size)]
+
+    return process_urls(check_url_batch, batches, redirect, executor)
 
 
 def main(argv: Optional[List[str]] = None) -> int:
@@ -581,7 +781,7 @@ def main(argv: Optional[List[str]] = None) -> int:
         fatal('No package directories found in %s', args.local_packages)
         return 1
 
-    spec_style = spectree.determine_spec_tree_style(args.local_packages)
+    spec_style = spectree.determine_spec_tree_style(args.local_packages, sample_path=spec_packages[-1])
     info('Spec file checkout style in use is %s', spectree.SPEC_STYLE_NAME[spec_style])
     if spec_style == spectree.SpecStyle.SPEC_STYLE_UNKNOWN:
         fatal('Unknown checkout style')
@@ -606,22 +806,18 @@ def main(argv: Optional[List[str]] = None) -> int:
 
     if not args.skip_url_check:
         info('Starting checking %d URLs', len(proc.result))
-        # De-dupe the URLs then check them all
-        checked_urls = check_urls(set(entry.url for entry in proc.result))
-
-        # Check REDIRECT entries again, but redirecting this time.
-        recheck_urls = set(u for u, s in checked_urls.items() if s == UrlStatus.REDIRECT)
-        if recheck_urls:
-            info('Starting checking %d redirected URLs', len(recheck_urls))
-            rechecked_urls = check_urls(recheck_urls, redirect=True)
-            checked_urls = {**checked_urls, **rechecked_urls}
-
-        # Check TEMPORARY_ERR entries again.
-        recheck_urls = set(u for u, s in checked_urls.items() if s == UrlStatus.TEMPORARY_ERR)
-        if recheck_urls:
-            info('Starting rechecking %d temporary error URLs', len(recheck_urls))
-            rechecked_urls = check_urls(recheck_urls, redirect=True)
-            checked_urls = {**checked_urls, **rechecked_urls}
+        # The same worker threads are used for all the checks
+        with concurrent.futures.ThreadPoolExecutor(max_workers=PARALLEL_URL_THREADS) as executor:
+            # De-dupe the URLs then check them all
+            checked_urls = check_urls(set(entry.url for entry in proc.result), executor=executor)
+
+            # Check REDIRECT entries again, but redirecting this time, and
+            # TEMPORARY_ERR entries again. Following redirects doesn't hurt the
+            # latter, so they're all done together in one pass.
+            recheck_urls = [u for u, s in checked_urls.items() if s in RECHECK_STATUSES]
+            if recheck_urls:
+                info('Starting rechecking %d redirected and temporary error URLs', len(recheck_urls))
+                checked_urls.update(check_urls(recheck_urls, redirect=True, executor=executor))
 
         # Update the status of all the original URLs with what was discovered
         proc.update_url_status(checked_urls)
@@ -11,25 +11,44 @@ Usage: bad-url-report >report.html 2>errors.log
 
 # TODO: maybe rename this module to reporting or something more specific
 
-import collections
+from __future__ import annotations
+
+import base64
 import enum
+import functools
 import glob
+import gzip
+import http.client
 import os
+import re
 import shlex
 import stat
+import subprocess
+import urllib.parse
+import urllib.request
+import zlib
+from collections.abc import Callable, Iterable
 from logging import debug, error, info
-from typing import Dict, List
 
 
 # Default glob pattern to match local .srpm files
 LOCAL_PACKAGE_GLOB = '*'
 
+# Matches the special characters in a glob pattern
+GLOB_MAGIC_RE = re.compile(r'[*?[]')
+
 # Source for the maintdb
 MAINTDB_URL = 'https://pkgsubmit.mageia.org/data/maintdb.txt'
 
 # String to use for an unknown packager
 UNKNOWN_PACKAGER = '?'
 
+# Seconds to wait for an HTTP server to respond
+HTTP_TIMEOUT = 60
+
+# Errors that can come from retrieving a URL and decompressing the response
+URL_ERRORS = (OSError, EOFError, zlib.error, http.client.HTTPException)
+
 
 class SpecStyle(enum.IntEnum):
     '''The layout of the user's spec file tree.'''
@@ -46,86 +65,201 @@ SPEC_STYLE_NAME = {
     SpecStyle.SPEC_STYLE_SPEC_ONLY: 'spec only',
 }
 
+# Directories between the package directory and its spec file for each style,
+# with a trailing separator
+SPEC_STYLE_SUBDIRS = {
+    SpecStyle.SPEC_STYLE_MASSIVE: os.path.join('current', 'SPECS', ''),
+    SpecStyle.SPEC_STYLE_INDIVIDUAL: os.path.join('SPECS', ''),
+    SpecStyle.SPEC_STYLE_SPEC_ONLY: '',
+}
+
 
-def get_local_package_paths(package_glob: str) -> List[str]:
+def file_mode(path: str) -> int:
+    '''Return the mode of the file, following it only if it's a symlink.
+
+    Symlinks are rare in a checkout, so lstat() usually saves resolving one.
+    '''
+    mode = os.lstat(path).st_mode
+    if stat.S_ISLNK(mode):
+        mode = os.stat(path).st_mode
+    return mode
+
+
+def get_local_package_paths(package_glob: str) -> list[str]:
     'Get a list of local package paths with spec files to check'
-    spec_packages = glob.glob(package_glob)
-    return [f for f in spec_packages if stat.S_ISDIR(os.stat(f).st_mode)]
+    dir_part, pattern = os.path.split(package_glob)
+    if pattern == '*' and not GLOB_MAGIC_RE.search(dir_part):
+        # The common case of every entry in one directory. The directory
+        # entries already say which are directories, which saves a stat() on
+        # each one (except for symlinks). Like glob, skip hidden entries.
+        try:
+            with os.scandir(dir_part or os.curdir) as it:
+                return [os.path.join(dir_part, entry.name) for entry in it
+                        if entry.name[0] != '.' and entry.is_dir()]
+        except OSError:
+            return []
+    return [f for f in glob.iglob(package_glob) if stat.S_ISDIR(file_mode(f))]
 
 
-def determine_spec_tree_style(package_glob: str) -> int:
-    'Figure out why kind of style of SVN checkout is in use'
-    package_file = glob.glob(package_glob)[-1]
+def determine_spec_tree_style(package_glob: str, *, sample_path: str | None = None) -> int:
+    '''Figure out why kind of style of SVN checkout is in use
+
+    sample_path - a package path matching package_glob to check, to save
+        globbing again when the caller already has the list of packages
+    '''
+    package_file = sample_path if sample_path is not None else glob.glob(package_glob)[-1]
     debug('Checking spec style based on %s', package_file)
+    # One directory listing shows which of the entries for each style exist
     try:
-        if stat.S_ISDIR(os.stat(os.path.join(package_file, 'current', 'SPECS')).st_mode):
-            return SpecStyle.SPEC_STYLE_MASSIVE
+        with os.scandir(package_file) as it:
+            entries = {entry.name: entry for entry in it}
     except OSError:
-        pass
+        return SpecStyle.SPEC_STYLE_UNKNOWN
 
-    try:
-        if stat.S_ISDIR(os.stat(os.path.join(package_file, 'SPECS')).st_mode):
-            return SpecStyle.SPEC_STYLE_INDIVIDUAL
-    except OSError:
-        pass
+    current = entries.get('current')
+    if current and current.is_dir():
+        try:
+            if stat.S_ISDIR(file_mode(os.path.join(current.path, 'SPECS'))):
+                return SpecStyle.SPEC_STYLE_MASSIVE
+        except OSError:
+            pass
 
-    package = os.path.basename(package_file)
-    try:
-        if stat.S_ISREG(os.stat(os.path.join(package_file, package + '.spec')).st_mode):
-            return SpecStyle.SPEC_STYLE_SPEC_ONLY
-    except OSError:
-        pass
+    specs = entries.get('SPECS')
+    if specs and specs.is_dir():
+        return SpecStyle.SPEC_STYLE_INDIVIDUAL
+
+    spec = entries.get(os.path.basename(package_file) + '.spec')
+    if spec and spec.is_file():
+        return SpecStyle.SPEC_STYLE_SPEC_ONLY
 
     return SpecStyle.SPEC_STYLE_UNKNOWN
 
 
-def get_packagers_mgarepo() -> Dict[str, str]:
+class PackagerMap(dict):
+    '''A dict of packagers for each package that returns UNKNOWN_PACKAGER for unknown packages.
+
+    Unlike a defaultdict, looking up an unknown package doesn't add it.
+    '''
+    __slots__ = ()
+
+    def __missing__(self, key: str) -> str:
+        return UNKNOWN_PACKAGER
+
+
+def get_packagers_mgarepo() -> dict[str, str]:
     '''Retrieve a dict containing packagers for each package
 
     This uses the mgarepo command to get the maintdb, but that requires a
     Mageia packager account. Although this function isn't currently used, it's
     still a working alternative in case MAINTDB_URL ever goes away.'''
-    packagers = collections.defaultdict(lambda: UNKNOWN_PACKAGER)
-    cmd = 'mgarepo maintdb get'
-    info("Running: %s", cmd)
-    with os.popen(cmd, 'r') as pipe:
-        while line := pipe.readline():
-            try:
-                package, packager = tuple(line.strip().split())
-            except ValueError:
-                error('Problem getting packager on %s' % line.strip())
-            else:
-                packagers[package] = packager
-        if pipe.close():
-            error('Problem retrieving the maintdb')
+    return get_packagers_from_command(['mgarepo', 'maintdb', 'get'])
+
+
+def get_packagers() -> dict[str, str]:
+    '''Retrieve a dict containing packagers for each package
+
+    The maintdb is retrieved in-process rather than by running curl.'''
+    info('Retrieving: %s', MAINTDB_URL)
+    try:
+        with urllib.request.urlopen(make_request(MAINTDB_URL), timeout=HTTP_TIMEOUT) as resp:
+            if resp.headers.get('Content-Encoding') == 'gzip':
+                with gzip.GzipFile(fileobj=resp) as uncompressed:
+                    return parse_maintdb(uncompressed)
+            return parse_maintdb(resp)
+    except URL_ERRORS as e:
+        error('Problem retrieving the maintdb: %s', e)
+        return PackagerMap()
+
+
+def get_packagers_from_command(cmd: list[str]) -> dict[str, str]:
+    '''Retrieve a dict containing packagers for each package from a command
+
+    The command must write the maintdb to stdout.'''
+    info("Running: %s", shlex.join(cmd))
+    try:
+        with subprocess.Popen(cmd, stdout=subprocess.PIPE) as proc:
+            packagers = parse_maintdb(proc.stdout)
+    except OSError as e:
+        error('Problem retrieving the maintdb: %s', e)
+        return PackagerMap()
+    if proc.returncode:
+        error('Problem retrieving the maintdb')
     return packagers
 
 
-def get_packagers() -> Dict[str, str]:
-    'Retrieve a dict containing packagers for each package'
-    packagers = collections.defaultdict(lambda: UNKNOWN_PACKAGER)
-    cmd = 'curl -f -s --compressed ' + shlex.quote(MAINTDB_URL)
-    info("Running: %s", cmd)
-    with os.popen(cmd, 'r') as pipe:
-        while line := pipe.readline():
-            try:
-                package, packager = tuple(line.strip().split())
-            except ValueError:
-                error('Problem getting packager on %s' % line.strip())
-            else:
-                packagers[package] = packager
-        if pipe.close():
-            error('Problem retrieving the maintdb')
+def parse_maintdb(maintdb: Iterable[bytes]) -> dict[str, str]:
+    '''Return a dict containing packagers for each package in the maintdb.
+
+    The lines are read as they arrive and split as bytes, so only the
+    fields that are kept are decoded into strings.
+    '''
+    packagers = PackagerMap()
+    for line in maintdb:
+        # split() already ignores leading and trailing whitespace
+        fields = line.split()
+        if len(fields) == 2:
+            packagers[fields[0].decode('utf-8', errors='replace')] = fields[1].decode('utf-8', errors='replace')
+        else:
+            error('Problem getting packager on %s' % line.strip().decode('utf-8', errors='replace'))
     return packagers
 
 
+def make_request(url: str) -> urllib.request.Request:
+    '''Return a request for the URL that accepts a gzip-compressed response.
+
+    urllib doesn't handle credentials in the URL itself, so like curl they
+    are sent with Basic authentication.
+    '''
+    headers = {'Accept-Encoding': 'gzip', 'User-Agent': 'spec-tree'}
+    u = urllib.parse.urlsplit(url)
+    if u.username is not None:
+        credentials = urllib.parse.unquote(u.username) + ':' + urllib.parse.unquote(u.password or '')
+        headers['Authorization'] = 'Basic ' + base64.b64encode(credentials.encode()).decode('ascii')
+        url = u._replace(netloc=u.netloc.rpartition('@')[2]).geturl()
+    return urllib.request.Request(url, headers=headers)
+
+
+def retrieve_url(url: str) -> bytes | None:
+    '''Return the body of the URL, or None on error.
+
+    Like curl, any proxy configured in the environment is used.
+    '''
+    request = make_request(url)
+    # This URL has any credentials removed so they don't end up in the logs
+    info('Retrieving: %s', request.full_url)
+    try:
+        with urllib.request.urlopen(request, timeout=HTTP_TIMEOUT) as resp:
+            body = resp.read()
+            if resp.headers.get('Content-Encoding') == 'gzip':
+                body = gzip.decompress(body)
+    except URL_ERRORS as e:
+        error('Error retrieving %s: %s', request.full_url, e)
+        return None
+    return body
+
+
 def make_spec_path(package_file: str, spec_style: int) -> str:
     '''Creates a file path from the package name and spec tree style.'''
-    package = os.path.basename(package_file)
-    if spec_style == SpecStyle.SPEC_STYLE_MASSIVE:
-        return os.path.join(package_file, 'current', 'SPECS', package + '.spec')
-    if spec_style == SpecStyle.SPEC_STYLE_INDIVIDUAL:
-        return os.path.join(package_file, 'SPECS', package + '.spec')
-    if spec_style == SpecStyle.SPEC_STYLE_SPEC_ONLY:
-        return os.path.join(package_file, package + '.spec')
-    raise RuntimeError('Unsupported spec style %d' % spec_style)
+    return specialize_make_spec_path(spec_style)(package_file)
+
+
+@functools.lru_cache(maxsize=None)
+def specialize_make_spec_path(spec_style: int) -> Callable[[str], str]:
+    '''Return a function that creates a spec file path from the package name.
+
+    This is like make_spec_path() with the style lookup done once in advance,
+    for creating the paths of many packages in the same spec tree. There is
+    only one function for each style, so it's cached.
+    '''
+    try:
+        subdir = os.sep + SPEC_STYLE_SUBDIRS[spec_style]
+    except KeyError:
+        raise RuntimeError('Unsupported spec style %d' % spec_style) from None
+    basename = os.path.basename
+
+    def spec_path(package_file: str) -> str:
+        # Package paths never end in a separator, so there's no need for the
+        # generality (and overhead) of os.path.join()
+        return f'{package_file}{subdir}{basename(package_file)}.spec'
+
+    return spec_path